@@ -0,0 +1,285 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# Sleep between two attempts to get a concurrency slot, doubled after
+# every failed attempt up to MAX_POLL_INTERVAL
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.05
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS buckets ("
+    " sub TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS slots ("
+    " route_class TEXT NOT NULL, pid INTEGER NOT NULL, in_use INTEGER NOT NULL,"
+    " PRIMARY KEY (route_class, pid))",
+    "CREATE TABLE IF NOT EXISTS queues ("
+    " route_class TEXT PRIMARY KEY, first_above REAL)",
+)
+
+'''
+AdmissionError Exception
+A request rejected by the admission controller, with the number of
+seconds after which the client may retry
+'''
+
+
+class AdmissionError(Exception):
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+'''
+AdmissionStore
+    the admission state shared by every worker of a host, kept in a
+    local SQLite file: token buckets, concurrency slots and queue state
+'''
+
+
+class AdmissionStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections must not cross threads or forks
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # the state only matters while the workers run, so a commit
+            # need not wait for an fsync
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection)
+            connection.execute("COMMIT")
+            return result
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def take_token(self, sub, rate, burst):
+        """
+        Take a token from the bucket of sub. Returns 0 on success, or the
+        number of seconds until a token is available.
+        """
+        def work(connection):
+            now = time.time()
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE sub = ?", (sub,)).fetchone()
+            tokens = burst if row is None else \
+                min(burst, row[0] + (now - row[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (sub, tokens, updated) VALUES (?, ?, ?)",
+                (sub, tokens, now))
+            return wait
+        return self._transaction(work)
+
+    def acquire(self, route_class, limit):
+        """
+        Take a concurrency slot of route_class if fewer than limit are in use
+        """
+        pid = os.getpid()
+
+        # check without the write lock first, so that waiting requests
+        # only read while every slot is held by a live worker
+        if self._full(self._connection(), route_class, limit):
+            return False
+
+        def work(connection):
+            in_use = connection.execute(
+                "SELECT COALESCE(SUM(in_use), 0) FROM slots WHERE route_class = ?",
+                (route_class,)).fetchone()[0]
+            if in_use >= limit:
+                in_use -= self._reclaim(connection, route_class)
+            if in_use >= limit:
+                return False
+            connection.execute(
+                "INSERT OR IGNORE INTO slots (route_class, pid, in_use) VALUES (?, ?, 0)",
+                (route_class, pid))
+            connection.execute(
+                "UPDATE slots SET in_use = in_use + 1 WHERE route_class = ? AND pid = ?",
+                (route_class, pid))
+            return True
+        return self._transaction(work)
+
+    def release(self, route_class):
+        # a single statement is atomic on its own
+        self._connection().execute(
+            "UPDATE slots SET in_use = MAX(in_use - 1, 0) WHERE route_class = ? AND pid = ?",
+            (route_class, os.getpid()))
+
+    @staticmethod
+    def _full(connection, route_class, limit):
+        # every slot is in use and none of them is held by a dead worker
+        rows = connection.execute(
+            "SELECT pid, in_use FROM slots WHERE route_class = ?", (route_class,)).fetchall()
+        if sum(in_use for _, in_use in rows) < limit:
+            return False
+        return all(_alive(pid) for pid, in_use in rows if in_use)
+
+    def _reclaim(self, connection, route_class):
+        # free the slots held by workers that died while serving requests
+        reclaimed = 0
+        for pid, in_use in connection.execute(
+                "SELECT pid, in_use FROM slots WHERE route_class = ?", (route_class,)).fetchall():
+            if not _alive(pid):
+                connection.execute("DELETE FROM slots WHERE pid = ?", (pid,))
+                reclaimed += in_use
+        return reclaimed
+
+    def standing_queue(self, route_class, above_target, interval):
+        """
+        Record whether a request waited longer than the target. Returns
+        True once requests have waited longer than the target for a whole
+        interval, i.e. the queue is not draining (CoDel).
+        """
+        # requests under the target only read, and write just once when
+        # the queue drains; a single statement needs no transaction
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT first_above FROM queues WHERE route_class = ?",
+            (route_class,)).fetchone()
+        if not above_target:
+            if row is not None:
+                connection.execute(
+                    "DELETE FROM queues WHERE route_class = ?", (route_class,))
+            return False
+        if row is None:
+            connection.execute(
+                "INSERT OR IGNORE INTO queues (route_class, first_above) VALUES (?, ?)",
+                (route_class, time.time()))
+            return False
+        return time.time() - row[0] >= interval
+
+
+'''
+AdmissionController
+    admits the requests of an app: per-token rate limits, a concurrency
+    limit per route class (read or write) and load shedding once requests
+    wait longer than the target queue delay
+'''
+
+
+class AdmissionController:
+    def __init__(self, app):
+        self.config = app.config
+        self.store = AdmissionStore(app.config["ADMISSION_STORE_PATH"])
+        app.extensions["admission"] = self
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def check_rate(self, payload):
+        """
+        Take a token for the subject of a decoded JWT, or raise a 429
+        """
+        sub = payload.get("sub")
+        if not sub:
+            return
+        try:
+            wait = self.store.take_token(sub, self.config["RATE_LIMIT_PER_SECOND"],
+                                         self.config["RATE_LIMIT_BURST"])
+        except sqlite3.Error as e:
+            logger.warning("Admission store unavailable: %s", e)
+            return
+        if wait:
+            raise AdmissionError({
+                "code": "rate_limited",
+                "description": "Too many requests for this token."
+            }, 429, wait)
+
+    def admit(self):
+        """
+        Wait for a concurrency slot of the request's route class, or raise
+        a 503 when the queue delay stays above the target
+        """
+        if request.method == "OPTIONS":
+            return
+
+        route_class = "read" if request.method in ("GET", "HEAD") else "write"
+        limit = self.config["{}_CONCURRENCY".format(route_class.upper())]
+        target = self.config["QUEUE_TARGET_MS"] / 1000
+        interval = self.config["QUEUE_INTERVAL_MS"] / 1000
+        arrived = _request_start()
+
+        try:
+            poll_interval = POLL_INTERVAL
+            while not self.store.acquire(route_class, limit):
+                delay = time.time() - arrived
+                if delay > target and \
+                        self.store.standing_queue(route_class, True, interval):
+                    raise AdmissionError({
+                        "code": "overloaded",
+                        "description": "The service is overloaded."
+                    }, 503, interval)
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+            g.admission_slot = route_class
+
+            # the delay includes the time spent queued in the router and gunicorn
+            delay = time.time() - arrived
+            if self.store.standing_queue(route_class, delay > target, interval):
+                raise AdmissionError({
+                    "code": "overloaded",
+                    "description": "The service is overloaded."
+                }, 503, interval)
+
+        except sqlite3.Error as e:
+            logger.warning("Admission store unavailable: %s", e)
+
+    def release(self, exception=None):
+        route_class = g.pop("admission_slot", None)
+        if route_class is None:
+            return
+        try:
+            self.store.release(route_class)
+        except sqlite3.Error as e:
+            logger.warning("Admission store unavailable: %s", e)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _request_start():
+    """
+    Return when the request reached the platform: the X-Request-Start header
+    set by the Heroku router (in milliseconds, optionally prefixed by "t="),
+    or else the time we started to handle it
+    """
+    header = request.headers.get("X-Request-Start", "")
+    try:
+        started = float(header[2:] if header.startswith("t=") else header)
+    except ValueError:
+        return time.time()
+
+    # accept seconds, milliseconds or microseconds since the epoch
+    while started > time.time() * 10:
+        started /= 1000
+    return min(started, time.time())
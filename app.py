@@ -1,16 +1,66 @@
 from flask import Flask, request, jsonify, abort
 from sqlalchemy import exc
 import json
+import math
 from flask_cors import CORS
-from models import setup_db, Actor, Movie, db, db_drop_and_create_all
+from config import load_config
+from startup import track_startup, warmup
+from admission import AdmissionController, AdmissionError
+from groupcommit import GroupCommitter
+from models import setup_db, Actor, Movie, db, db_drop_and_create_all, update_versioned, \
+    MovieCastSize, ReleaseYearCount, ActorDemographic, actor_schema, movie_schema
+from schemas import ValidationError
 from auth import AuthError, requires_auth
+from idempotency import idempotent
+from coalesce import coalesced, coalescer
+from querylog import slow_queries
+from bulk import export_response, import_format, import_rows
+from stats import fresh_stats, refresh_stats
+
+
+def expected_versions(body):
+    """
+    Return the versions a PATCH may apply to, from the If-Match header or
+    else the "version" field of the body, and the status code to abort
+    with when the row is at another version
+    """
+
+    # If-Match carries the ETag of a previous response, i.e. the version
+    if request.if_match:
+        if request.if_match.star_tag:
+            return None, 412
+        try:
+            return [int(tag) for tag in request.if_match.as_set(include_weak=True)], 412
+        except ValueError:
+            return [], 412
+
+    # the body's version is checked like the other fields, before any SQL
+    version = body.get("version")
+    if version is not None:
+        if not isinstance(version, int) or isinstance(version, bool):
+            raise ValidationError({"version": "must be an integer"})
+        return [version], 409
+
+    return None, 409
 
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(load_config(test_config))
+    setup_db(app, app.config["SQLALCHEMY_DATABASE_URI"])
     CORS(app, resources={"/": {"origins": "*"}})
+    track_startup(app)
+
+    # rate limit tokens and shed load before requests reach the handlers
+    if app.config["ADMISSION_ENABLED"]:
+        AdmissionController(app)
+
+    # batch the writes of concurrent requests into shared transactions
+    if app.config["GROUP_COMMIT_ENABLED"]:
+        app.extensions["group_commit"] = GroupCommitter(
+            app.config["GROUP_COMMIT_WINDOW_MS"] / 1000,
+            app.config["GROUP_COMMIT_MAX_BATCH"])
 
     # Uncomment this line for the first time use only.
     # db_drop_and_create_all()
@@ -19,7 +69,7 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add("Access-Control-Allow-Headers",
-                             "Content-Type, Authorization, true")
+                             "Content-Type, Authorization, Idempotency-Key, If-Match, true")
         response.headers.add("Access-Control-Allow-Methods",
                              "GET, PATCH, POST, DELETE, OPTIONS")
         return response
@@ -44,6 +94,7 @@ def create_app(test_config=None):
     """
     @app.route('/actors')
     @requires_auth("get:actors")
+    @coalesced
     def get_actors(payload):
 
         # retrieve all actors from db
@@ -67,6 +118,7 @@ def create_app(test_config=None):
     """
     @app.route('/movies')
     @requires_auth("get:movies")
+    @coalesced
     def get_movies(payload):
 
         # retrieve all movies from db
@@ -90,25 +142,10 @@ def create_app(test_config=None):
     """
     @app.route("/actors", methods=["POST"])
     @requires_auth("post:actors")
-    def post_actors(payload):
-
-        # retrieve data fields from the request body
-        body = request.get_json()
-
-        new_name = body.get("name", None)
-        new_age = body.get("age", None)
-        new_gender = body.get("gender", None)
-        new_movie_id = body.get("movie_id", None)
-
-        # abort 422 if any field is blank
-        if not (new_name and new_age and new_gender and new_movie_id):
-            abort(422)
-
+    @idempotent(actor_schema)
+    def post_actors(payload, values):
         # try to add the new data into db
-        new_actor = Actor(name=new_name,
-                          age=new_age,
-                          gender=new_gender,
-                          movie_id=new_movie_id)
+        new_actor = Actor(**values)
 
         try:
             new_actor.insert()
@@ -130,21 +167,10 @@ def create_app(test_config=None):
     """
     @app.route("/movies", methods=["POST"])
     @requires_auth("post:movies")
-    def post_movies(payload):
-
-        # retrieve data fields from the request body
-        body = request.get_json()
-
-        new_title = body.get("title", None)
-        new_release_year = body.get("release_year", None)
-
-        # abort 422 if any field is blank
-        if not new_title or not new_release_year:
-            abort(422)
-
+    @idempotent(movie_schema)
+    def post_movies(payload, values):
         # try to add the new data into db
-        new_movie = Movie(title=new_title,
-                          release_year=new_release_year)
+        new_movie = Movie(**values)
 
         try:
             new_movie.insert()
@@ -171,43 +197,37 @@ def create_app(test_config=None):
         # get id from kwargs
         id = kwargs["id"]
 
-        # get actor by a given id
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-
-        # abort 404 if no actor found
-        if actor is None:
-            abort(404)
-
         # retrieve data fields from the request body
         body = request.get_json()
 
-        if "name" in body:
-            actor.name = body.get("name")
-
-        if "age" in body:
-            actor.age = body.get("age")
+        # validate the fields present in the body before touching the database
+        values = actor_schema.load(body, partial=True)
 
-        if "gender" in body:
-            actor.gender = body.get("gender")
-
-        if "movie_id" in body:
-            actor.movie_id = body.get("movie_id")
-
-        # update new data in db
+        # update new data in db if the actor is still at the expected version
+        versions, status_code = expected_versions(body)
         try:
-            actor.update()
+            updated = update_versioned(Actor, id, values, versions)
 
         # abort 422 if any error
         except Exception as e:
             print("Error: ", str(e))
             abort(422)
 
+        # abort 404 if no actor found, or 412/409 if it was modified since
+        actor = Actor.query.filter(Actor.id == id).one_or_none()
+        if actor is None:
+            abort(404)
+        if not updated:
+            abort(status_code)
+
         # returns status code 200 and json file where actors
         # is an array containing only the newly modified actor
-        return jsonify({
+        response = jsonify({
             "success": True,
             "actors": [actor.format()]
         })
+        response.set_etag(str(actor.version))
+        return response
 
     """
     A private endpoint for patching a movie by a given id
@@ -219,37 +239,37 @@ def create_app(test_config=None):
         # get id from kwargs
         id = kwargs["id"]
 
-        # get movie by a given id
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-
-        # abort 404 if no movie found
-        if movie is None:
-            abort(404)
-
         # retrieve data fields from the request body
         body = request.get_json()
 
-        if "title" in body:
-            movie.title = body.get("title")
-
-        if "release_year" in body:
-            movie.release_year = body.get("release_year")
+        # validate the fields present in the body before touching the database
+        values = movie_schema.load(body, partial=True)
 
-        # update new data in db
+        # update new data in db if the movie is still at the expected version
+        versions, status_code = expected_versions(body)
         try:
-            movie.update()
+            updated = update_versioned(Movie, id, values, versions)
 
         # abort 422 if any error
         except Exception as e:
             print("Error: ", str(e))
             abort(422)
 
+        # abort 404 if no movie found, or 412/409 if it was modified since
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+        if not updated:
+            abort(status_code)
+
         # returns status code 200 and json file where movies
         # is an array containing only the newly modified movie
-        return jsonify({
+        response = jsonify({
             "success": True,
             "movies": [movie.format()]
         })
+        response.set_etag(str(movie.version))
+        return response
 
     """
     A private endpoint for deleting a actor by given id
@@ -317,6 +337,178 @@ def create_app(test_config=None):
             "deleted": id
         })
 
+    #################################### Bulk Endpoints ##############################
+
+    """
+    A private endpoint for exporting all actors as CSV or NDJSON
+    """
+    @app.route('/export/actors')
+    @requires_auth("get:actors")
+    def export_actors(payload):
+
+        # abort 422 if the requested format is not supported
+        try:
+            return export_response("actors", request.args.get("format", "csv"))
+        except ValueError:
+            abort(422)
+
+    """
+    A private endpoint for exporting all movies as CSV or NDJSON
+    """
+    @app.route('/export/movies')
+    @requires_auth("get:movies")
+    def export_movies(payload):
+
+        # abort 422 if the requested format is not supported
+        try:
+            return export_response("movies", request.args.get("format", "csv"))
+        except ValueError:
+            abort(422)
+
+    """
+    A private endpoint for importing actors from a CSV or NDJSON upload
+    """
+    @app.route('/import/actors', methods=["POST"])
+    @requires_auth("post:actors")
+    def import_actors(payload):
+
+        # abort 422 if the upload format is not supported
+        try:
+            fmt = import_format(request.mimetype, request.args.get("format"))
+        except ValueError:
+            abort(422)
+
+        # parse and load the upload, returning the import report
+        report = import_rows("actors", request.stream, fmt)
+
+        return jsonify(dict(success=True, **report))
+
+    """
+    A private endpoint for importing movies from a CSV or NDJSON upload
+    """
+    @app.route('/import/movies', methods=["POST"])
+    @requires_auth("post:movies")
+    def import_movies(payload):
+
+        # abort 422 if the upload format is not supported
+        try:
+            fmt = import_format(request.mimetype, request.args.get("format"))
+        except ValueError:
+            abort(422)
+
+        # parse and load the upload, returning the import report
+        report = import_rows("movies", request.stream, fmt)
+
+        return jsonify(dict(success=True, **report))
+
+    #################################### Stats Endpoints #############################
+
+    """
+    A private endpoint for getting the number of actors cast in each movie
+    """
+    @app.route('/stats/cast-sizes')
+    @requires_auth("get:movies")
+    def get_cast_sizes(payload):
+
+        # read the precomputed counts, refreshing them if they are too old
+        # and no other request is already doing so
+        refreshed_at = fresh_stats()
+        cast_sizes = MovieCastSize.query.order_by(MovieCastSize.movie_id).all()
+
+        return jsonify({
+            "success": True,
+            "refreshed_at": refreshed_at and refreshed_at.isoformat(),
+            "cast_sizes": [cast_size.format() for cast_size in cast_sizes]
+        })
+
+    """
+    A private endpoint for getting the number of movies released each year
+    """
+    @app.route('/stats/release-years')
+    @requires_auth("get:movies")
+    def get_release_years(payload):
+
+        # read the precomputed counts, refreshing them if they are too old
+        # and no other request is already doing so
+        refreshed_at = fresh_stats()
+        release_years = ReleaseYearCount.query.order_by(
+            ReleaseYearCount.release_year).all()
+
+        return jsonify({
+            "success": True,
+            "refreshed_at": refreshed_at and refreshed_at.isoformat(),
+            "release_years": [year.format() for year in release_years]
+        })
+
+    """
+    A private endpoint for getting the number of actors by age group and gender
+    """
+    @app.route('/stats/actor-demographics')
+    @requires_auth("get:actors")
+    def get_actor_demographics(payload):
+
+        # read the precomputed counts, refreshing them if they are too old
+        # and no other request is already doing so
+        refreshed_at = fresh_stats()
+        demographics = ActorDemographic.query.order_by(
+            ActorDemographic.age_group, ActorDemographic.gender).all()
+
+        return jsonify({
+            "success": True,
+            "refreshed_at": refreshed_at and refreshed_at.isoformat(),
+            "actor_demographics": [group.format() for group in demographics]
+        })
+
+    """
+    A command for recomputing the statistics tables, e.g. from a scheduler
+    """
+    @app.cli.command("refresh-stats")
+    def refresh_stats_command():
+        print("Statistics refreshed at", refresh_stats().isoformat())
+
+    #################################### Admin Endpoints #############################
+
+    """
+    A private endpoint for getting the startup timings of this worker
+    """
+    @app.route('/admin/startup')
+    @requires_auth("get:admin")
+    def get_startup(payload):
+
+        return jsonify({
+            "success": True,
+            "startup": app.extensions["startup"]
+        })
+
+    """
+    A private endpoint for getting the slow queries logged by this worker
+    """
+    @app.route('/admin/slow-queries')
+    @requires_auth("get:admin")
+    def get_slow_queries(payload):
+
+        # filter by route, or keep only the queries with a plan if requested
+        entries = slow_queries.entries(
+            route=request.args.get("route"),
+            explained=request.args.get("explained", "").lower() == "true")
+
+        return jsonify({
+            "success": True,
+            "slow_queries": entries
+        })
+
+    """
+    A private endpoint for getting the read coalescing counters of this worker
+    """
+    @app.route('/admin/coalescing')
+    @requires_auth("get:admin")
+    def get_coalescing(payload):
+
+        return jsonify({
+            "success": True,
+            "coalescing": coalescer.stats()
+        })
+
     ###################################### Error Handling ######################################
     '''
     Error handling for unprocessable entity
@@ -329,6 +521,18 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    '''
+    Error handling for a request body rejected by a schema
+    '''
+    @app.errorhandler(ValidationError)
+    def invalid_body(ex):
+        return jsonify({
+            "success": False,
+            "error": 422,
+            "message": "unprocessable",
+            "errors": ex.errors
+        }), 422
+
     '''
     Error handling for resource not found 
     '''
@@ -340,6 +544,28 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    '''
+    Error handling for a request conflicting with another one
+    '''
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    '''
+    Error handling for a failed If-Match precondition
+    '''
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
     '''
     Error handler for AuthError
     '''
@@ -349,10 +575,20 @@ def create_app(test_config=None):
         response.status_code = ex.status_code
         return response
 
-    return app
+    '''
+    Error handler for AdmissionError
+    '''
+    @app.errorhandler(AdmissionError)
+    def handle_admission_error(ex):
+        response = jsonify(ex.error)
+        response.status_code = ex.status_code
+        response.headers["Retry-After"] = str(max(1, math.ceil(ex.retry_after)))
+        return response
 
+    return app
 
-app = create_app()
 
 if __name__ == '__main__':
+    app = create_app()
+    warmup(app)
     app.run()
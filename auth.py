@@ -1,7 +1,8 @@
 import json
-from flask import request, _request_ctx_stack
+import threading
+import time
+from flask import request, current_app, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
 
@@ -9,6 +10,18 @@ AUTH0_DOMAIN = 'fsnd-akira.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+# How long the Auth0 public keys are cached, and how soon they may be
+# fetched again for a token signed with an unknown key
+JWKS_TTL = 600
+JWKS_MIN_REFRESH = 30
+
+# How long fetching the Auth0 public keys, or waiting for another thread
+# to fetch them, may take
+JWKS_TIMEOUT = 5
+
+_jwks = {"keys": None, "fetched_at": 0, "fetching": None}
+_jwks_lock = threading.Lock()
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -88,14 +101,65 @@ def check_permissions(permission, payload):
     return True
 
 
+def get_jwks(max_age=JWKS_TTL):
+    """
+    Return the public keys of Auth0, fetching them if older than max_age.
+    One thread fetches them at a time, outside the lock; the others wait
+    for it, then use the keys they have if the fetch failed.
+    """
+    with _jwks_lock:
+        if _jwks["keys"] is not None and time.time() - _jwks["fetched_at"] <= max_age:
+            return _jwks["keys"]
+        fetching = _jwks["fetching"]
+        leader = fetching is None
+        if leader:
+            fetching = _jwks["fetching"] = threading.Event()
+
+    if not leader:
+        fetching.wait(JWKS_TIMEOUT)
+    else:
+        try:
+            jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                              timeout=JWKS_TIMEOUT)
+            keys = json.loads(jsonurl.read())
+            with _jwks_lock:
+                _jwks["keys"] = keys
+                _jwks["fetched_at"] = time.time()
+        except Exception as e:
+            current_app.logger.warning("Could not fetch the JWKS: %s", e)
+        finally:
+            with _jwks_lock:
+                _jwks["fetching"] = None
+            fetching.set()
+
+    # raise an AuthError if no keys were ever fetched
+    if _jwks["keys"] is None:
+        raise AuthError({
+            "code": "jwks_unavailable",
+            "description": "Unable to fetch the public keys of the issuer."
+        }, 503)
+    return _jwks["keys"]
+
+
+def prefetch_jwks():
+    """
+    Fetch the public keys of Auth0 and load the JWT library ahead of the
+    first request
+    """
+    from jose import jwt  # noqa: F401
+    return get_jwks(max_age=0)
+
+
 def verify_decode_jwt(token):
     """
     Validating the Auth0 token
     """
 
+    # import the JWT library (and its crypto backends) on first use only
+    from jose import jwt
+
     # get the public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    jwks = get_jwks()
 
     # get the data in the header
     unverified_header = jwt.get_unverified_header(token)
@@ -108,6 +172,10 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    # fetch the keys again if Auth0 has rotated them since
+    if not any(key['kid'] == unverified_header['kid'] for key in jwks['keys']):
+        jwks = get_jwks(max_age=JWKS_MIN_REFRESH)
+
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -171,6 +239,10 @@ def requires_auth(permission=''):
             payload = verify_decode_jwt(token)
             # use the check_permissions method validate claims and check the requested permission
             check_permissions(permission, payload)
+            # take a token from the rate limit of the token's subject
+            admission = current_app.extensions.get("admission")
+            if admission is not None:
+                admission.check_rate(payload)
             # return the decorator which passes the decoded payload to the decorated method
             return f(payload, *args, **kwargs)
         return wrapper
@@ -0,0 +1,79 @@
+"""
+Benchmark single-record inserts with and without group commit.
+
+    python bench_group_commit.py [--database URL] [--threads N] [--writes N]
+
+Each thread inserts movies one at a time, as concurrent POST /movies
+requests would. Defaults to a SQLite file, so that every commit is fsynced.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from app import create_app
+from models import db, Movie
+
+
+def run(database, threads, writes, group_commit, window_ms, max_batch):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": database,
+        "ADMISSION_ENABLED": False,
+        "GROUP_COMMIT_ENABLED": group_commit,
+        "GROUP_COMMIT_WINDOW_MS": window_ms,
+        "GROUP_COMMIT_MAX_BATCH": max_batch,
+    })
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.remove()
+
+    errors = []
+
+    def insert():
+        with app.app_context():
+            for i in range(writes):
+                try:
+                    Movie(title="Movie {}".format(i), release_year=2020).insert()
+                except Exception as e:
+                    errors.append(e)
+                    db.session.rollback()
+            db.session.remove()
+
+    workers = [threading.Thread(target=insert) for _ in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.time() - started
+
+    with app.app_context():
+        rows = Movie.query.count()
+        db.engine.dispose()
+    return rows / seconds, rows, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", default="sqlite:///" + os.path.join(
+        tempfile.gettempdir(), "bench_group_commit.db"))
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=100,
+                        help="inserts per thread")
+    parser.add_argument("--window-ms", type=float, default=2)
+    parser.add_argument("--max-batch", type=int, default=64)
+    args = parser.parse_args()
+
+    print("{} threads x {} inserts on {}".format(args.threads, args.writes, args.database))
+    print("{:<14}{:>14}{:>10}{:>10}".format("mode", "writes/s", "rows", "errors"))
+    for group_commit in (False, True):
+        rate, rows, errors = run(args.database, args.threads, args.writes,
+                                 group_commit, args.window_ms, args.max_batch)
+        mode = "group commit" if group_commit else "per request"
+        print("{:<14}{:>14.1f}{:>10}{:>10}".format(mode, rate, rows, errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark the cost per record of validating and encoding with the schemas.
+
+    python bench_schemas.py [--records N]
+
+Validation loads a JSON payload as POST /actors does, or a CSV row as the
+import does. Encoding dumps an actor as its format() does for a response.
+No database is needed.
+"""
+import argparse
+import time
+
+from models import Actor, Movie, actor_schema, movie_schema
+
+
+def per_record(work, items):
+    started = time.perf_counter()
+    for item in items:
+        work(item)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=100000)
+    args = parser.parse_args()
+
+    actor_bodies = [{"name": "Actor {}".format(i), "age": 20 + i % 60,
+                     "gender": "female", "movie_id": 1 + i % 100}
+                    for i in range(args.records)]
+    actor_rows = [{key: str(value) for key, value in body.items()}
+                  for body in actor_bodies]
+    movie_bodies = [{"title": "Movie {}".format(i), "release_year": 1950 + i % 70}
+                    for i in range(args.records)]
+    actors = [Actor(id=i, version=1, **body) for i, body in enumerate(actor_bodies, 1)]
+    movies = [Movie(id=i, version=1, **body) for i, body in enumerate(movie_bodies, 1)]
+
+    print("{} records, microseconds per record".format(args.records))
+    print("{:<32}{:>10}".format("operation", "us"))
+    for name, work, items in (
+            ("validate actor (JSON)", actor_schema.load, actor_bodies),
+            ("validate actor (CSV, coerced)",
+             lambda row: actor_schema.load(row, coerce=True), actor_rows),
+            ("validate movie (JSON)", movie_schema.load, movie_bodies),
+            ("encode actor", actor_schema.dump, actors),
+            ("encode movie", movie_schema.dump, movies),
+            ("validate + encode actor",
+             lambda body: actor_schema.dump(Actor(**actor_schema.load(body))),
+             actor_bodies)):
+        print("{:<32}{:>10.2f}".format(name, per_record(work, items)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import csv
+import io
+import json
+import time
+
+from flask import Response, stream_with_context
+from models import db, actor_schema, movie_schema
+from schemas import ValidationError
+
+# Number of rows fetched from the cursor or loaded per transaction
+CHUNK_SIZE = 5000
+
+# Number of bytes buffered before a chunk of the export is sent
+FLUSH_SIZE = 64 * 1024
+
+# Maximum number of rejected rows described in an import report
+MAX_REPORTED_ERRORS = 100
+
+# Replacement for the bytes of an upload that are not valid UTF-8
+INVALID_CHARACTER = "\ufffd"
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+'''
+RESOURCES
+    the schema of every resource that supports bulk transfer, whose
+    fields are exported and whose writable fields are imported
+'''
+RESOURCES = {
+    "actors": actor_schema,
+    "movies": movie_schema,
+}
+
+
+'''
+RowError Exception
+A rejected import row, described by its message
+'''
+
+
+class RowError(Exception):
+    pass
+
+
+def check_format(fmt):
+    """
+    Raise ValueError for a format we cannot read or write
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unsupported format: {}".format(fmt))
+    return fmt
+
+
+def import_format(mimetype, fmt=None):
+    """
+    Pick the upload format from the Content-Type, falling back to ?format=
+    """
+    for name, content_type in FORMATS.items():
+        if mimetype == content_type:
+            return name
+    if mimetype == "application/ndjson":
+        return "ndjson"
+    return check_format(fmt or "csv")
+
+
+###################################### Export ######################################
+
+def export_response(resource, fmt):
+    """
+    Stream every row of a resource, ordered by id, as CSV or NDJSON
+    """
+    check_format(fmt)
+    schema = RESOURCES[resource]
+    model = schema.model
+
+    # yield_per makes psycopg2 use a server-side (named) cursor, so only
+    # one chunk of rows is held in memory at any time
+    columns = [getattr(model, field) for field in schema.fields]
+    query = db.session.query(*columns).order_by(model.id).yield_per(CHUNK_SIZE)
+
+    encode = _encode_csv if fmt == "csv" else _encode_ndjson
+    response = Response(stream_with_context(encode(schema, query)),
+                        mimetype=FORMATS[fmt])
+    response.headers["Content-Disposition"] = \
+        "attachment; filename={}.{}".format(resource, fmt)
+    return response
+
+
+def _encode_csv(schema, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(schema.fields)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= FLUSH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _encode_ndjson(schema, rows):
+    chunk = []
+    size = 0
+    for row in rows:
+        line = json.dumps(schema.dump_row(row)) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= FLUSH_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    yield "".join(chunk)
+
+
+###################################### Import ######################################
+
+def import_rows(resource, stream, fmt):
+    """
+    Parse an uploaded stream incrementally and load the valid rows in chunks.
+    Returns a report with row counts, throughput and the rejected rows.
+    """
+    check_format(fmt)
+    schema = RESOURCES[resource]
+
+    started = time.time()
+    imported = 0
+    rejected = 0
+    errors = []
+
+    def reject(line, message):
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"line": line, "error": message})
+
+    records = _read_csv(schema, stream) if fmt == "csv" else _read_ndjson(stream)
+    chunk = []
+
+    for line, record in records:
+        try:
+            chunk.append((line, _validate(schema, record, fmt == "csv")))
+        except (RowError, ValidationError) as e:
+            rejected += 1
+            reject(line, str(e))
+            continue
+
+        if len(chunk) >= CHUNK_SIZE:
+            loaded = _load_chunk(schema, chunk, reject)
+            imported += loaded
+            rejected += len(chunk) - loaded
+            chunk = []
+
+    if chunk:
+        loaded = _load_chunk(schema, chunk, reject)
+        imported += loaded
+        rejected += len(chunk) - loaded
+
+    seconds = time.time() - started
+    return {
+        "imported": imported,
+        "rejected": rejected,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round((imported + rejected) / seconds, 1) if seconds else None
+    }
+
+
+def _lines(stream):
+    # read the upload line by line instead of buffering the whole body.
+    # utf-8-sig drops a leading BOM, and bytes that are not UTF-8 become
+    # U+FFFD so that their row can be rejected on its own.
+    for line in iter(stream.readline, b""):
+        yield line.decode("utf-8-sig", errors="replace")
+
+
+def _read_csv(schema, stream):
+    reader = csv.reader(_lines(stream))
+    header = next(reader, None)
+    if header is None:
+        return
+    if any(INVALID_CHARACTER in name for name in header):
+        raise ValidationError({"header": "is not valid UTF-8"})
+    header = [name.strip() for name in header]
+
+    # every row would be rejected, so fail before reading them
+    missing = [field for field in schema.writable
+               if field in schema.required and field not in header]
+    if missing:
+        raise ValidationError({"header": "is missing {}".format(", ".join(missing))})
+    for row in reader:
+        if not row:
+            continue
+        if any(INVALID_CHARACTER in value for value in row):
+            yield reader.line_num, RowError("is not valid UTF-8")
+            continue
+        if len(row) != len(header):
+            yield reader.line_num, RowError("expected {} fields, got {}".format(
+                len(header), len(row)))
+            continue
+        yield reader.line_num, dict(zip(header, row))
+
+
+def _read_ndjson(stream):
+    for line, text in enumerate(_lines(stream), 1):
+        if not text.strip():
+            continue
+        if INVALID_CHARACTER in text:
+            yield line, RowError("is not valid UTF-8")
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line, RowError("invalid JSON: {}".format(e))
+            continue
+        if not isinstance(record, dict):
+            yield line, RowError("expected a JSON object")
+            continue
+        yield line, record
+
+
+def _validate(schema, record, coerce):
+    """
+    Return the row as a tuple of the writable fields, raising RowError or
+    ValidationError if the record is invalid. CSV values are all strings,
+    so they are coerced to the column types.
+    """
+    if isinstance(record, RowError):
+        raise record
+
+    values = schema.load(record, coerce=coerce)
+    return tuple(values.get(field) for field in schema.writable)
+
+
+def _load_chunk(schema, chunk, reject):
+    """
+    Load one chunk in its own transaction. If the database refuses it
+    (e.g. an unknown movie_id), load each half on its own, down to single
+    rows, so that only the refused rows are rejected.
+    """
+    model = schema.model
+    names = schema.writable
+    rows = [row for _, row in chunk]
+
+    try:
+        if db.engine.dialect.name == "postgresql":
+            _copy_rows(model.__tablename__, names, rows)
+        else:
+            db.session.execute(model.__table__.insert(),
+                               [dict(zip(names, row)) for row in rows])
+        db.session.commit()
+        return len(rows)
+
+    except Exception as e:
+        db.session.rollback()
+        if len(chunk) > 1:
+            middle = len(chunk) // 2
+            return _load_chunk(schema, chunk[:middle], reject) + \
+                _load_chunk(schema, chunk[middle:], reject)
+
+        print("Error: ", str(e))
+        reject(chunk[0][0], str(e).splitlines()[0])
+        return 0
+
+
+def _copy_rows(table, names, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    # COPY runs on the session's own connection so it commits with it
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+            table, ", ".join(names)), buffer)
+    finally:
+        cursor.close()
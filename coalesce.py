@@ -0,0 +1,116 @@
+import threading
+from functools import wraps
+
+from flask import Response, request, abort, make_response
+from werkzeug.exceptions import HTTPException
+
+# How long a follower waits for the leader before running the query itself
+WAIT_TIMEOUT = 5
+
+
+'''
+Flight
+    one in-flight request, whose serialized response is shared by
+    every identical request arriving before it finishes
+'''
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.status_code = None
+
+
+'''
+Coalescer
+    runs identical concurrent read requests once per worker: the first
+    one (the leader) runs the handler and the others (the followers)
+    wait for its serialized response
+'''
+
+
+class Coalescer:
+    def __init__(self, timeout=WAIT_TIMEOUT):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {"leaders": 0, "coalesced": 0, "timeouts": 0}
+
+    def run(self, key, handler):
+        """
+        Return the response of handler, shared with identical requests
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self._stats["leaders"] += 1
+
+        if leader:
+            return self._lead(key, flight, handler)
+
+        # fall back to running the handler if the leader takes too long
+        if not flight.done.wait(self.timeout):
+            self._count("timeouts")
+            return handler()
+
+        # the leader failed with an HTTP error, so fail the same way
+        if flight.status_code is not None:
+            self._count("coalesced")
+            abort(flight.status_code)
+
+        # the leader failed with an unexpected error, so try again alone
+        if flight.response is None:
+            return handler()
+
+        self._count("coalesced")
+        body, status, headers = flight.response
+        return Response(body, status=status, headers=headers)
+
+    def _lead(self, key, flight, handler):
+        try:
+            response = make_response(handler())
+            flight.response = (response.get_data(), response.status_code,
+                               list(response.headers))
+            return response
+        except HTTPException as e:
+            flight.status_code = e.code
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        Return the coalescing counters of this worker
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._flights)
+        return stats
+
+
+coalescer = Coalescer()
+
+
+def coalesced(f):
+    """
+    Define a decorator method sharing the response of identical concurrent
+    GET requests. It goes under requires_auth: requests are identical when
+    they have the same route, query string and permissions.
+    """
+
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = (request.path,
+               tuple(sorted(request.args.items(multi=True))),
+               tuple(sorted(payload.get("permissions", []))))
+        return coalescer.run(key, lambda: f(payload, *args, **kwargs))
+    return wrapper
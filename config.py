@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+from models import database_path
+
+'''
+load_config(test_config=None)
+    returns the settings of the app, read from the environment and then
+    overridden by test_config
+'''
+
+
+def load_config(test_config=None):
+    config = {
+        # Heroku provides the database in DATABASE_URL
+        "SQLALCHEMY_DATABASE_URI": os.environ.get("DATABASE_URL", database_path),
+
+        # Number of pooled connections opened by the warmup, 0 for the pool size
+        "WARMUP_CONNECTIONS": int(os.environ.get("WARMUP_CONNECTIONS", 0)),
+
+        # Statements slower than this are logged, and a sample of them explained
+        "SLOW_QUERY_SECONDS": float(os.environ.get("SLOW_QUERY_SECONDS", 0.5)),
+        "SLOW_QUERY_EXPLAIN_RATE": float(os.environ.get("SLOW_QUERY_EXPLAIN_RATE", 0.1)),
+        "SLOW_QUERY_LOG_SIZE": int(os.environ.get("SLOW_QUERY_LOG_SIZE", 100)),
+
+        # Postgres statement timeout in milliseconds, per endpoint, 0 for none
+        "STATEMENT_TIMEOUT_MS": int(os.environ.get("STATEMENT_TIMEOUT_MS", 5000)),
+        "STATEMENT_TIMEOUTS": {
+            "export_actors": 0,
+            "export_movies": 0,
+            "import_actors": 0,
+            "import_movies": 0,
+            "get_cast_sizes": 60000,
+            "get_release_years": 60000,
+            "get_actor_demographics": 60000,
+        },
+
+        # Admission control, with its state shared by the workers in a local file
+        "ADMISSION_ENABLED": os.environ.get("ADMISSION_ENABLED", "true").lower() == "true",
+        "ADMISSION_STORE_PATH": os.environ.get(
+            "ADMISSION_STORE_PATH",
+            os.path.join(tempfile.gettempdir(), "capstone-admission.db")),
+        "RATE_LIMIT_PER_SECOND": float(os.environ.get("RATE_LIMIT_PER_SECOND", 10)),
+        "RATE_LIMIT_BURST": float(os.environ.get("RATE_LIMIT_BURST", 20)),
+        "READ_CONCURRENCY": int(os.environ.get("READ_CONCURRENCY", 16)),
+        "WRITE_CONCURRENCY": int(os.environ.get("WRITE_CONCURRENCY", 4)),
+        "QUEUE_TARGET_MS": int(os.environ.get("QUEUE_TARGET_MS", 100)),
+        "QUEUE_INTERVAL_MS": int(os.environ.get("QUEUE_INTERVAL_MS", 1000)),
+
+        # Commit the inserts and updates of concurrent requests together,
+        # waiting up to the window for a batch to fill up
+        "GROUP_COMMIT_ENABLED": os.environ.get("GROUP_COMMIT_ENABLED", "false").lower() == "true",
+        "GROUP_COMMIT_WINDOW_MS": float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 2)),
+        "GROUP_COMMIT_MAX_BATCH": int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 64)),
+    }
+    if test_config:
+        config.update(test_config)
+
+    # a bucket that never refills, or never holds a token, rejects every request
+    if config["RATE_LIMIT_PER_SECOND"] <= 0:
+        raise ValueError("RATE_LIMIT_PER_SECOND must be positive")
+    if config["RATE_LIMIT_BURST"] < 1:
+        raise ValueError("RATE_LIMIT_BURST must be at least 1")
+    return config
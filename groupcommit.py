@@ -0,0 +1,112 @@
+import threading
+
+from models import db
+
+'''
+Write
+    one write submitted to the group committer, with its result or error
+'''
+
+
+class Write:
+    def __init__(self, work):
+        self.work = work
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+'''
+Batch
+    the writes committed together in one transaction
+'''
+
+
+class Batch:
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+
+
+'''
+GroupCommitter
+    commits the writes of concurrent requests of a worker together: the
+    first write of a batch commits at once when no other batch is being
+    committed. Otherwise it waits for the window to pass or the batch to
+    fill up, then runs every write of the batch in one transaction.
+'''
+
+
+class GroupCommitter:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._open = None
+        self._committing = 0
+        self._lock = threading.Lock()
+
+    def submit(self, work):
+        """
+        Run work(connection) in the next batch and return its result once
+        the batch is committed, or raise its error
+        """
+        write = Write(work)
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = Batch()
+                # a lone write has nothing to wait for
+                busy = self._committing > 0
+            batch.writes.append(write)
+            if len(batch.writes) >= self.max_batch:
+                self._open = None
+                batch.full.set()
+
+        if leader:
+            if busy:
+                batch.full.wait(self.window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+                self._committing += 1
+            try:
+                self._commit(batch.writes)
+            finally:
+                with self._lock:
+                    self._committing -= 1
+        else:
+            write.done.wait()
+
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _commit(self, writes):
+        # each write runs in a savepoint, so that a failing one is rolled
+        # back alone and the others are still committed
+        try:
+            with db.engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    for write in writes:
+                        savepoint = connection.begin_nested()
+                        try:
+                            write.result = write.work(connection)
+                            savepoint.commit()
+                        except Exception as e:
+                            savepoint.rollback()
+                            write.error = e
+                    transaction.commit()
+                except BaseException:
+                    transaction.rollback()
+                    raise
+
+        except Exception as e:
+            for write in writes:
+                write.result = None
+                write.error = write.error or e
+
+        finally:
+            for write in writes:
+                write.done.set()
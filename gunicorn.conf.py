@@ -0,0 +1,17 @@
+import os
+
+# Create the app once in the master process and fork it into the workers.
+# create_app does not connect to anything, so nothing is shared across forks.
+preload_app = True
+
+# Serve several requests per worker on threads, so that identical reads
+# can be coalesced and concurrent writes committed together
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+
+def post_worker_init(worker):
+    # each worker opens its own pool and fetches the Auth0 keys before
+    # accepting requests
+    from startup import warmup
+    warmup(worker.wsgi)
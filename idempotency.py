@@ -0,0 +1,246 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, g, request, abort, make_response
+from sqlalchemy import exc
+from models import db, IdempotencyKey
+
+KEY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Number of stored responses kept in memory by each worker
+LRU_SIZE = 1024
+
+# How long a stored response can be replayed
+KEY_TTL = timedelta(hours=24)
+
+# How long a request waits for another one holding the same key
+WAIT_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+# Age after which an unfinished claim is considered abandoned by a dead
+# worker, well past the 30 seconds after which the router gives up on a
+# request. A leader that still finishes later rolls back and returns 409.
+CLAIM_TIMEOUT = 300
+
+# Expired keys are purged from the database once every PURGE_EVERY claims
+PURGE_EVERY = 100
+
+
+'''
+IdempotencyStore
+    remembers the response of every keyed request in an in-process LRU
+    backed by the idempotency_keys table, and single-flights concurrent
+    requests with the same key
+'''
+
+
+class IdempotencyStore:
+    def __init__(self, size=LRU_SIZE):
+        self.size = size
+        self._cache = OrderedDict()
+        self._flights = {}
+        self._claims = 0
+        self._lock = threading.Lock()
+
+    def run(self, key, fingerprint, handler):
+        """
+        Return the stored response for key, or run handler once and store it
+        """
+        deadline = time.time() + WAIT_TIMEOUT
+        while True:
+            stored = self._get(key)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+
+            # only one thread of this worker runs the handler for a key,
+            # the others wait for it and then read the stored response
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = threading.Event()
+
+            if not leader:
+                if not flight.wait(deadline - time.time()):
+                    abort(409)
+                continue
+
+            try:
+                return self._lead(key, fingerprint, handler, deadline)
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.set()
+
+    def _lead(self, key, fingerprint, handler, deadline):
+        # claim the key in the database so other workers wait for us
+        claimed_at = datetime.utcnow()
+        stored = self._claim(key, fingerprint, claimed_at, deadline)
+        if stored is not None:
+            return self._replay(stored, fingerprint)
+
+        # the handler runs in a savepoint, so that its commit only releases
+        # the savepoint and its writes commit along with the stored response
+        g.idempotency_key = key
+        transaction = db.session().transaction
+        db.session.begin_nested()
+        try:
+            response = make_response(handler())
+        except BaseException:
+            self._release(key, claimed_at, transaction)
+            raise
+
+        # server errors are not stored, so that the client can retry
+        if response.status_code >= 500:
+            self._release(key, claimed_at, transaction)
+            return response
+
+        # release any savepoint the handler left open
+        while db.session().transaction is not transaction:
+            db.session.commit()
+
+        # store the response only if the claim is still ours, otherwise
+        # roll back the handler's writes as well
+        table = IdempotencyKey.__table__
+        stored = (fingerprint, response.status_code,
+                  response.get_data(as_text=True), claimed_at)
+        updated = db.session.execute(table.update().where(
+            (table.c.key == key) & (table.c.created_at == claimed_at) &
+            table.c.status_code.is_(None)).values(
+            status_code=stored[1], body=stored[2])).rowcount
+        if not updated:
+            db.session.rollback()
+            abort(409)
+        db.session.commit()
+        self._put(key, stored)
+        return response
+
+    def _claim(self, key, fingerprint, claimed_at, deadline):
+        """
+        Insert an unfinished record for key. If another request holds it,
+        wait until it finishes and return its stored response.
+        """
+        self._purge()
+        table = IdempotencyKey.__table__
+        while True:
+            # Core statements keep the session's identity map out of the loop
+            try:
+                db.session.execute(table.insert().values(
+                    key=key, fingerprint=fingerprint, created_at=claimed_at))
+                db.session.commit()
+                return None
+            except exc.IntegrityError:
+                db.session.rollback()
+
+            record = db.session.execute(
+                table.select().where(table.c.key == key)).first()
+            if record is None:
+                continue
+
+            # drop an expired response, or take over a claim whose owner
+            # died without finishing it, unless it changed since we read it
+            age = datetime.utcnow() - record.created_at
+            condition = (table.c.key == key) & (table.c.created_at == record.created_at)
+            if record.status_code is None:
+                condition &= table.c.status_code.is_(None)
+            if age > KEY_TTL or (record.status_code is None and
+                                 age.total_seconds() > CLAIM_TIMEOUT):
+                db.session.execute(table.delete().where(condition))
+                db.session.commit()
+                continue
+
+            if record.status_code is not None:
+                stored = (record.fingerprint, record.status_code, record.body,
+                          record.created_at)
+                self._put(key, stored)
+                return stored
+
+            if time.time() >= deadline:
+                abort(409)
+            db.session.rollback()
+            time.sleep(POLL_INTERVAL)
+
+    def _release(self, key, claimed_at, transaction):
+        # roll back the handler's writes and drop our claim, so that a
+        # retry runs the handler again
+        transaction.rollback()
+        table = IdempotencyKey.__table__
+        db.session.execute(table.delete().where(
+            (table.c.key == key) & (table.c.created_at == claimed_at)))
+        db.session.commit()
+
+    def _purge(self):
+        with self._lock:
+            self._claims += 1
+            if self._claims % PURGE_EVERY:
+                return
+        IdempotencyKey.query.filter(
+            IdempotencyKey.created_at < datetime.utcnow() - KEY_TTL).delete()
+        db.session.commit()
+
+    def _replay(self, stored, fingerprint):
+        # the same key must not be reused for a different request body
+        if stored[0] != fingerprint:
+            abort(422)
+        response = Response(stored[2], status=stored[1], mimetype="application/json")
+        response.headers[REPLAYED_HEADER] = "true"
+        return response
+
+    def _get(self, key):
+        with self._lock:
+            stored = self._cache.get(key)
+            if stored is None:
+                return None
+            # a response is only replayed for KEY_TTL
+            if datetime.utcnow() - stored[3] > KEY_TTL:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return stored
+
+    def _put(self, key, stored):
+        with self._lock:
+            self._cache[key] = stored
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+
+store = IdempotencyStore()
+
+
+def idempotent(schema):
+    """
+    Define a decorator method replaying the stored response of a request
+    made again with the same Idempotency-Key header. It goes under
+    requires_auth so that keys are scoped by the token subject. The body
+    is loaded with schema before a key is claimed, so an invalid request
+    returns 422 without touching the database, and the decorated method
+    gets the loaded values after the payload.
+    """
+
+    def idempotent_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            # a ValidationError returns 422 with the invalid fields
+            values = schema.load(request.get_json())
+
+            key = request.headers.get(KEY_HEADER)
+            if not key:
+                return f(payload, values, *args, **kwargs)
+
+            # abort 422 if the key is too long to be stored
+            if len(key) > 255:
+                abort(422)
+
+            scoped_key = "{}:{}:{}".format(payload.get("sub", ""), request.path, key)
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            return store.run(scoped_key, fingerprint,
+                             lambda: f(payload, values, *args, **kwargs))
+        return wrapper
+    return idempotent_decorator
@@ -1,6 +1,11 @@
-from sqlalchemy import Column, String, create_engine, Integer
+from sqlalchemy import Column, String, create_engine, Integer, Text, DateTime, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from flask import current_app, g, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 import json
+from querylog import install_query_log
+from schemas import Schema
 
 database_name = "capstone"
 database_path = "postgres://{}@{}/{}".format(
@@ -10,7 +15,8 @@ db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, and installs
+    the slow query log on its engine
 '''
 
 
@@ -20,12 +26,106 @@ def setup_db(app, database_path=database_path):
     db.app = app
     db.init_app(app)
 
+    # time every statement, log the slow ones and apply statement timeouts
+    install_query_log()
+    install_sqlite_transactions()
+
+
+'''
+install_sqlite_transactions()
+    makes SQLite transactions start when SQLAlchemy begins them. pysqlite
+    only sends BEGIN before its first INSERT or UPDATE, and never before a
+    SAVEPOINT, so a savepoint released outside a transaction commits alone.
+'''
+
+
+def install_sqlite_transactions():
+    if event.contains(Pool, "connect", _sqlite_connect):
+        return
+    event.listen(Pool, "connect", _sqlite_connect)
+    event.listen(Engine, "begin", _sqlite_begin)
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        # leave BEGIN and COMMIT to SQLAlchemy
+        dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(connection):
+    if connection.dialect.name == "sqlite":
+        connection.connection.execute("BEGIN")
+
 
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
 
+'''
+group_committer()
+    returns the group committer of the current app, or None when every
+    write commits its own transaction, as do the writes of a request
+    made with an Idempotency-Key
+'''
+
+
+def group_committer():
+    if not has_app_context():
+        return None
+    # a keyed request commits its writes with its stored response
+    if has_request_context() and "idempotency_key" in g:
+        return None
+    return current_app.extensions.get("group_commit")
+
+
+'''
+group_insert(committer, record)
+    inserts a new Actor or Movie in the next group commit and sets its id
+'''
+
+
+def group_insert(committer, record):
+    table = record.__table__
+    if record.version is None:
+        record.version = 1
+    values = {column.key: getattr(record, column.key)
+              for column in table.columns
+              if getattr(record, column.key) is not None}
+    record.id = committer.submit(
+        lambda connection: connection.execute(
+            table.insert().values(values)).inserted_primary_key[0])
+
+
+'''
+update_versioned(model, id, values, versions=None)
+    applies values to the row of model with the given id and bumps its
+    version in one conditional UPDATE, without locking the row.
+    When versions is given the row is only updated if its version is one
+    of them. Returns the number of updated rows, 0 or 1.
+'''
+
+
+def update_versioned(model, id, values, versions=None):
+    table = model.__table__
+    statement = table.update().where(table.c.id == id)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+
+    values = dict(values)
+    values["version"] = table.c.version + 1
+    statement = statement.values(values)
+
+    committer = group_committer()
+    if committer is not None:
+        return committer.submit(
+            lambda connection: connection.execute(statement).rowcount)
+
+    count = db.session.execute(statement).rowcount
+    db.session.commit()
+    return count
+
+
 '''
 Movie
 Have title and release year
@@ -40,12 +140,20 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_year = Column(Integer)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    # Bump version on every ORM update, which then only applies to
+    # the version that was read
+    __mapper_args__ = {"version_id_col": version}
 
     # Define a relationship to join with actors table
     actors = db.relationship('Actor', backref='movies')
 
-    # Add data
+    # Add data, in the next group commit if enabled
     def insert(self):
+        committer = group_committer()
+        if committer is not None:
+            return group_insert(committer, self)
         db.session.add(self)
         db.session.commit()
 
@@ -60,11 +168,13 @@ class Movie(db.Model):
 
     # Format data
     def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_year': self.release_year
-        }
+        return movie_schema.dump(self)
+
+
+# Declare how movies are validated and encoded
+movie_schema = Schema(Movie,
+                      fields=('id', 'title', 'release_year', 'version'),
+                      required=('title', 'release_year'))
 
 
 '''
@@ -82,14 +192,22 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    # Bump version on every ORM update, which then only applies to
+    # the version that was read
+    __mapper_args__ = {"version_id_col": version}
 
     # Define a foreign key for joining movies table
     movie_id = db.Column(
         db.Integer,
         db.ForeignKey('movies.id'))
 
-    # Add data
+    # Add data, in the next group commit if enabled
     def insert(self):
+        committer = group_committer()
+        if committer is not None:
+            return group_insert(committer, self)
         db.session.add(self)
         db.session.commit()
 
@@ -103,11 +221,101 @@ class Actor(db.Model):
         db.session.commit()
 
     # format data
+    def format(self):
+        return actor_schema.dump(self)
+
+
+# Declare how actors are validated and encoded
+actor_schema = Schema(Actor,
+                      fields=('id', 'name', 'age', 'gender', 'movie_id', 'version'),
+                      required=('name', 'age', 'gender', 'movie_id'))
+
+
+'''
+IdempotencyKey
+Have the stored response of a POST made with an Idempotency-Key header
+'''
+
+
+class IdempotencyKey(db.Model):
+    # Define the name of IdempotencyKey table
+    __tablename__ = 'idempotency_keys'
+
+    # Define the attributes, the key is scoped by token subject and route
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    body = Column(Text)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+
+'''
+MovieCastSize, ReleaseYearCount, ActorDemographic
+Have the precomputed statistics served by the /stats endpoints,
+recomputed from movies and actors by stats.refresh_stats
+'''
+
+
+class MovieCastSize(db.Model):
+    # Define the name of MovieCastSize table
+    __tablename__ = 'stats_cast_sizes'
+
+    # Define the attributes
+    movie_id = Column(Integer, primary_key=True)
+    actors = Column(Integer, nullable=False)
+
+    # Format data
+    def format(self):
+        return {
+            'movie_id': self.movie_id,
+            'actors': self.actors
+        }
+
+
+class ReleaseYearCount(db.Model):
+    # Define the name of ReleaseYearCount table
+    __tablename__ = 'stats_release_years'
+
+    # Define the attributes
+    release_year = Column(Integer, primary_key=True)
+    movies = Column(Integer, nullable=False)
+
+    # Format data
     def format(self):
         return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
+            'release_year': self.release_year,
+            'movies': self.movies
+        }
+
+
+class ActorDemographic(db.Model):
+    # Define the name of ActorDemographic table
+    __tablename__ = 'stats_actor_demographics'
+
+    # Define the attributes, age_group is the first year of a decade
+    age_group = Column(Integer, primary_key=True)
+    gender = Column(String, primary_key=True)
+    actors = Column(Integer, nullable=False)
+
+    # Format data
+    def format(self):
+        return {
+            'age_group': self.age_group,
             'gender': self.gender,
-            'movie_id': self.movie_id
+            'actors': self.actors
         }
+
+
+'''
+StatsRefresh
+Have the time the statistics tables were last recomputed, in a single row
+'''
+
+
+class StatsRefresh(db.Model):
+    # Define the name of StatsRefresh table
+    __tablename__ = 'stats_refreshes'
+
+    # Define the attributes
+    id = Column(Integer, primary_key=True)
+    refreshed_at = Column(DateTime, nullable=False)
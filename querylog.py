@@ -0,0 +1,181 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Defaults used outside of an app, overridden by the app config
+SLOW_QUERY_SECONDS = 0.5
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+SLOW_QUERY_LOG_SIZE = 100
+
+# Longest parameters representation kept with a slow query
+MAX_PARAMETERS_LENGTH = 500
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+
+'''
+SlowQueryLog
+    keeps the most recent slow queries of this worker, with the
+    EXPLAIN (ANALYZE, BUFFERS) output of the sampled ones
+'''
+
+
+class SlowQueryLog:
+    def __init__(self, size=SLOW_QUERY_LOG_SIZE):
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def resize(self, size):
+        with self._lock:
+            if size != self._entries.maxlen:
+                self._entries = deque(self._entries, maxlen=size)
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def entries(self, route=None, explained=False):
+        """
+        Return the slow queries, newest first, optionally only those of
+        a route or only those with a query plan
+        """
+        with self._lock:
+            entries = list(self._entries)
+        return [entry for entry in reversed(entries)
+                if (route is None or entry["route"] == route)
+                and (not explained or entry["plan"] is not None)]
+
+
+slow_queries = SlowQueryLog()
+
+
+def _setting(name, default):
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
+
+def _route():
+    if has_request_context():
+        return request.endpoint or request.path
+    return None
+
+
+def _statement_timeout(route):
+    # statements run outside of a request (commands, warmup) are not limited
+    if route is None:
+        return 0
+    timeouts = _setting("STATEMENT_TIMEOUTS", {})
+    return timeouts.get(route, _setting("STATEMENT_TIMEOUT_MS", 0))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.time()
+
+    if conn.dialect.name != "postgresql":
+        return
+
+    # SET lasts for the pooled connection, so only send it when it changes.
+    # It runs on its own cursor as this one may be a server-side cursor.
+    timeout = int(_statement_timeout(_route()))
+    if conn.info.get("statement_timeout") != timeout:
+        setter = conn.connection.cursor()
+        try:
+            setter.execute("SET statement_timeout = %s", (timeout,))
+        finally:
+            setter.close()
+        conn.info["statement_timeout"] = timeout
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.time() - conn.info.pop("query_started", time.time())
+    if seconds < _setting("SLOW_QUERY_SECONDS", SLOW_QUERY_SECONDS):
+        return
+
+    plan = None
+    if conn.dialect.name == "postgresql" and not executemany and \
+            statement.lstrip().upper().startswith("SELECT") and \
+            random.random() < _setting("SLOW_QUERY_EXPLAIN_RATE", SLOW_QUERY_EXPLAIN_RATE):
+        plan = _explain(conn, statement, parameters)
+
+    _record(statement, parameters, seconds, plan=plan)
+
+
+def handle_error(context):
+    # a statement cancelled by statement_timeout never reaches
+    # after_cursor_execute, yet it is the slowest of all
+    started = context.connection.info.pop("query_started", None) \
+        if context.connection is not None else None
+    if started is None or \
+            getattr(context.original_exception, "pgcode", None) != QUERY_CANCELED:
+        return
+    _record(context.statement, context.parameters, time.time() - started,
+            error="cancelled by statement_timeout")
+
+
+def _record(statement, parameters, seconds, plan=None, error=None):
+    route = _route()
+    shown_parameters = repr(parameters)[:MAX_PARAMETERS_LENGTH]
+    logger.warning("Slow query (%.3fs%s) in %s: %s %s",
+                   seconds, ", " + error if error else "", route, statement,
+                   shown_parameters)
+
+    slow_queries.resize(_setting("SLOW_QUERY_LOG_SIZE", SLOW_QUERY_LOG_SIZE))
+    slow_queries.add({
+        "at": datetime.utcnow().isoformat(),
+        "route": route,
+        "seconds": round(seconds, 3),
+        "statement": statement,
+        "parameters": shown_parameters,
+        "plan": plan,
+        "error": error
+    })
+
+
+def _explain(conn, statement, parameters):
+    """
+    Run the statement again under EXPLAIN (ANALYZE, BUFFERS). Only SELECTs
+    are explained, as ANALYZE executes the statement. A savepoint keeps a
+    failing EXPLAIN from aborting the request's transaction.
+    """
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT explain_slow_query")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+            return plan
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            logger.warning("Could not explain slow query: %s", e)
+            return None
+    finally:
+        cursor.close()
+
+
+def forget_statement_timeout(conn):
+    # a rolled back transaction also undoes the SET sent in it
+    conn.info.pop("statement_timeout", None)
+
+
+def install_query_log():
+    """
+    Listen to the statements of every engine, once per process
+    """
+    if event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+    event.listen(Engine, "rollback", forget_statement_timeout)
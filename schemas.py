@@ -0,0 +1,127 @@
+from operator import attrgetter
+
+# Range of the Integer columns, checked before the database rejects a value
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+'''
+ValidationError Exception
+A payload rejected by a schema, with one message per invalid field
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, errors):
+        super().__init__("; ".join("{}: {}".format(field, message)
+                                   for field, message in errors.items()))
+        self.errors = errors
+
+
+def _integer(coerce):
+    def check(value):
+        if coerce and isinstance(value, str):
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError("must be an integer")
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("must be an integer")
+        if not INTEGER_MIN <= value <= INTEGER_MAX:
+            raise ValueError("is out of range")
+        return value
+    return check
+
+
+def _string(length):
+    def check(value):
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        if length is not None and len(value) > length:
+            raise ValueError("must be at most {} characters".format(length))
+        return value
+    return check
+
+
+'''
+Schema
+    validates and encodes one resource, from the columns of its model.
+    The checks of every field are built once, when the schema is declared.
+'''
+
+
+class Schema:
+    def __init__(self, model, fields, required=(), read_only=("id", "version")):
+        columns = model.__table__.columns
+        self.model = model
+        self.fields = tuple(fields)
+        self.writable = tuple(field for field in fields if field not in read_only)
+        self.required = frozenset(required)
+
+        self._getter = attrgetter(*self.fields)
+        self._checks = {}
+        for coerce in (False, True):
+            self._checks[coerce] = tuple(
+                (field, field in self.required, self._check(columns[field], coerce))
+                for field in self.writable)
+
+    @staticmethod
+    def _check(column, coerce):
+        python_type = column.type.python_type
+        if python_type is int:
+            return _integer(coerce)
+        if python_type is str:
+            return _string(getattr(column.type, "length", None))
+        raise TypeError("No check for column {} of type {}".format(
+            column.key, column.type))
+
+    def load(self, data, partial=False, coerce=False):
+        """
+        Return the writable fields of a payload, raising ValidationError if
+        one is invalid or a required one is missing. A partial payload
+        (PATCH) may leave out required fields, and coerce accepts numbers
+        as strings (CSV). Read-only and unknown fields are ignored.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError({"body": "must be a JSON object"})
+
+        values = {}
+        errors = {}
+        for field, required, check in self._checks[coerce]:
+            if field not in data:
+                if required and not partial:
+                    errors[field] = "is required"
+                continue
+
+            value = data[field]
+            if coerce and isinstance(value, str):
+                value = value.strip()
+            if value is None or value == "":
+                if required:
+                    errors[field] = "is required"
+                else:
+                    values[field] = None
+                continue
+
+            try:
+                values[field] = check(value)
+            except ValueError as e:
+                errors[field] = str(e)
+
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    def dump(self, record):
+        """
+        Return a record as a dict of its fields
+        """
+        values = self._getter(record)
+        if len(self.fields) == 1:
+            values = (values,)
+        return dict(zip(self.fields, values))
+
+    def dump_row(self, row):
+        """
+        Return a row of self.fields, e.g. from a column query, as a dict
+        """
+        return dict(zip(self.fields, row))
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+from sqlalchemy import text
+from models import db, Actor, Movie
+
+# Time this module was imported, used when /proc is not available
+IMPORTED_AT = time.time()
+
+
+def process_started_at():
+    """
+    Return the time the current process was started
+    """
+    try:
+        # field 22 of /proc/self/stat is the start time in clock ticks after boot
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f
+                             if line.startswith("btime"))
+        return boot_time + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return IMPORTED_AT
+
+
+def track_startup(app):
+    """
+    Record how long the app took to create, warm up and serve its first request
+    """
+    started_at = process_started_at()
+    startup = app.extensions["startup"] = {
+        "pid": os.getpid(),
+        "created_seconds": round(time.time() - started_at, 3),
+        "warmup_seconds": None,
+        "first_request_seconds": None,
+    }
+    lock = threading.Lock()
+
+    @app.after_request
+    def record_first_request(response):
+        if startup["first_request_seconds"] is None:
+            with lock:
+                if startup["first_request_seconds"] is None:
+                    # a preloaded app is forked, so measure from this worker's start
+                    startup["pid"] = os.getpid()
+                    startup["first_request_seconds"] = round(
+                        time.time() - process_started_at(), 3)
+                    app.logger.info("First request served %.3fs after process start",
+                                    startup["first_request_seconds"])
+        return response
+
+
+def warmup(app):
+    """
+    Prepare a worker before it serves requests: fetch the Auth0 keys, open
+    the pooled connections and run the statements of the hot read paths.
+    Connections inherited from a preloading parent process are discarded.
+    """
+    from auth import prefetch_jwks
+
+    started = time.time()
+    with app.app_context():
+        db.engine.dispose()
+
+        try:
+            prefetch_jwks()
+        except Exception as e:
+            app.logger.warning("Warmup could not fetch the JWKS: %s", e)
+
+        try:
+            # check out several connections at once so the pool opens them all
+            size = app.config.get("WARMUP_CONNECTIONS") or \
+                getattr(db.engine.pool, "size", lambda: 1)()
+            connections = [db.engine.connect() for _ in range(size)]
+            for connection in connections:
+                connection.execute(text("SELECT 1"))
+                connection.close()
+
+            # configure the mappers and run the list queries once
+            Actor.query.order_by(Actor.id).limit(1).all()
+            Movie.query.order_by(Movie.id).limit(1).all()
+            db.session.remove()
+        except Exception as e:
+            app.logger.warning("Warmup could not prime the database pool: %s", e)
+
+    seconds = round(time.time() - started, 3)
+    if "startup" in app.extensions:
+        app.extensions["startup"]["warmup_seconds"] = seconds
+    app.logger.info("Warmup finished in %.3fs", seconds)
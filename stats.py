@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import exc, func
+from models import db, Actor, Movie, MovieCastSize, ReleaseYearCount, \
+    ActorDemographic, StatsRefresh
+
+# How old the statistics may get before a read recomputes them
+REFRESH_INTERVAL = timedelta(seconds=60)
+
+
+def _cast_sizes():
+    return db.session.query(Movie.id, func.count(Actor.id)) \
+        .outerjoin(Actor, Actor.movie_id == Movie.id) \
+        .group_by(Movie.id)
+
+
+def _release_years():
+    return db.session.query(Movie.release_year, func.count(Movie.id)) \
+        .filter(Movie.release_year.isnot(None)) \
+        .group_by(Movie.release_year)
+
+
+def _actor_demographics():
+    age_group = Actor.age - Actor.age % 10
+    return db.session.query(age_group, Actor.gender, func.count(Actor.id)) \
+        .filter(Actor.age.isnot(None), Actor.gender.isnot(None)) \
+        .group_by(age_group, Actor.gender)
+
+
+'''
+SUMMARIES
+    each statistics table and the GROUP BY query recomputing it
+'''
+SUMMARIES = (
+    (MovieCastSize, ("movie_id", "actors"), _cast_sizes),
+    (ReleaseYearCount, ("release_year", "movies"), _release_years),
+    (ActorDemographic, ("age_group", "gender", "actors"), _actor_demographics),
+)
+
+
+def _lock_state(skip_locked=False):
+    # the single refresh row serializes concurrent refreshes. With
+    # skip_locked, return None rather than wait if it is already locked.
+    state = StatsRefresh.query.filter(StatsRefresh.id == 1) \
+        .with_for_update(skip_locked=skip_locked).populate_existing().one_or_none()
+    if state is None:
+        if skip_locked and _refreshed_at() is not None:
+            return None
+        state = StatsRefresh(id=1, refreshed_at=datetime(1970, 1, 1))
+        db.session.add(state)
+        db.session.flush()
+    return state
+
+
+def _refreshed_at():
+    return db.session.query(StatsRefresh.refreshed_at) \
+        .filter(StatsRefresh.id == 1).scalar()
+
+
+def refresh_stats(max_age=None, wait=True):
+    """
+    Recompute every statistics table in one transaction and return the
+    refresh time. With max_age, skip it if another worker refreshed the
+    tables more recently than that while we waited for the lock. Without
+    wait, return None at once if another worker is refreshing them.
+    """
+    try:
+        state = _lock_state(skip_locked=not wait)
+    except exc.IntegrityError:
+        db.session.rollback()
+        state = _lock_state(skip_locked=not wait)
+
+    if state is None:
+        db.session.rollback()
+        return None
+
+    now = datetime.utcnow()
+    if max_age is not None and now - state.refreshed_at < max_age:
+        db.session.rollback()
+        return state.refreshed_at
+
+    for model, columns, query in SUMMARIES:
+        model.query.delete()
+        db.session.execute(
+            model.__table__.insert().from_select(columns, query().statement))
+
+    state.refreshed_at = now
+    db.session.commit()
+    return now
+
+
+def fresh_stats():
+    """
+    Return the refresh time of the statistics tables, recomputing them
+    first if they are older than REFRESH_INTERVAL. Only one reader
+    recomputes them: while it does, the others serve the current rows
+    instead of waiting for it.
+    """
+    refreshed_at = _refreshed_at()
+    if refreshed_at is not None and datetime.utcnow() - refreshed_at < REFRESH_INTERVAL:
+        return refreshed_at
+    return refresh_stats(REFRESH_INTERVAL, wait=False) or refreshed_at
@@ -1,9 +1,14 @@
 import unittest
 import json
+import threading
+import time
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import Movie, Actor
+from groupcommit import GroupCommitter
+from coalesce import coalescer
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -11,12 +16,11 @@ class CapstoneTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "capstone_test"
         self.database_path = "postgres://{}@{}/{}".format(
             "akira", 'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        self.app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_path})
+        self.client = self.app.test_client
 
         # binds the app to the current context
         with self.app.app_context():
@@ -239,6 +243,358 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 404)
         self.assertEqual(data['message'], 'resource not found')
 
+    # Creating a test for the /export/movies GET endpoint
+    def test_200_export_movies(self):
+        # Retrieving the movies as NDJSON
+        res = self.client().get('/export/movies?format=ndjson')
+        # Transforming the first line of the body into JSON
+        data = json.loads(res.data.splitlines()[0])
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(data['title'])
+
+    # Creating a test unprocessable for the /export/movies GET endpoint
+    def test_422_export_movies(self):
+        # Requesting an unsupported export format
+        res = self.client().get('/export/movies?format=xml')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable')
+
+    # Creating a test for the /import/movies POST endpoint
+    def test_200_import_movies(self):
+        # Uploading one valid and one invalid movie as CSV
+        res = self.client().post(
+            '/import/movies',
+            data='title,release_year\nBoss Level,2020\nBraveheart,soon\n',
+            content_type='text/csv')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+
+    # Creating a test for retrying the /movies POST endpoint
+    def test_200_post_movies_idempotent(self):
+        # Posting the same movie twice with one Idempotency-Key
+        headers = {'Idempotency-Key': 'test-post-movies'}
+        movie = {"title": "Boss Level", "release_year": 2020}
+        first = self.client().post('/movies', json=movie, headers=headers)
+        second = self.client().post('/movies', json=movie, headers=headers)
+
+        # Asserting that the retry replays the first response
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+
+    # Creating a test unprocessable for reusing an Idempotency-Key
+    def test_422_post_movies_idempotent(self):
+        # Reusing an Idempotency-Key with a different body
+        headers = {'Idempotency-Key': 'test-reuse-movies'}
+        self.client().post('/movies', json={"title": "Boss Level",
+                                            "release_year": 2020}, headers=headers)
+        res = self.client().post('/movies', json={"title": "Braveheart",
+                                                  "release_year": 1995}, headers=headers)
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Creating a test unprocessable for an invalid body with an Idempotency-Key
+    def test_422_post_movies_idempotent_invalid(self):
+        # Posting an invalid movie, then a valid one with the same key
+        headers = {'Idempotency-Key': 'test-invalid-movies'}
+        res = self.client().post('/movies', json={"title": "Boss Level",
+                                                  "release_year": "2020"}, headers=headers)
+        retry = self.client().post('/movies', json={"title": "Boss Level",
+                                                    "release_year": 2020}, headers=headers)
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that the invalid request did not claim the key
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {'release_year': 'must be an integer'})
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', retry.headers)
+
+    def test_200_get_coalescing(self):
+        # Calling a coalesced endpoint, then retrieving the counters
+        self.client().get('/movies')
+        res = self.client().get('/admin/coalescing')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertGreaterEqual(data['coalescing']['leaders'], 1)
+
+    # Creating a test precondition failed for the /movies PATCH endpoint
+    def test_412_update_movies(self):
+        # Calling patch endpoint with an outdated version in If-Match
+        self.client().patch('/movies/1', json={'title': 'Braveheart'})
+        res = self.client().patch('/movies/1', json={'title': 'Braveheart'},
+                                  headers={'If-Match': '"1"'})
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'precondition failed')
+
+    # Creating a test conflict for the /actors PATCH endpoint
+    def test_409_update_actors(self):
+        # Calling patch endpoint with an outdated version in the body
+        self.client().patch('/actors/1', json={'name': 'Frank Grillo'})
+        res = self.client().patch('/actors/1', json={'name': 'Frank Grillo',
+                                                     'version': 1})
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'conflict')
+
+    # Creating a test for the /stats/release-years GET endpoint
+    def test_200_get_release_years(self):
+        # Retrieving information from endpoint
+        res = self.client().get('/stats/release-years')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['refreshed_at'])
+        self.assertTrue(data['release_years'])
+
+    # Creating a test for the /stats/actor-demographics GET endpoint
+    def test_200_get_actor_demographics(self):
+        # Retrieving information from endpoint
+        res = self.client().get('/stats/actor-demographics')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['actor_demographics'])
+
+    # Creating a test for the /admin/startup GET endpoint
+    def test_200_get_startup(self):
+        # Serving a first request, then retrieving the timings
+        self.client().get('/')
+        res = self.client().get('/admin/startup')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsNotNone(data['startup']['first_request_seconds'])
+
+    # Creating a test for the /admin/slow-queries GET endpoint
+    def test_200_get_slow_queries(self):
+        # Logging every statement as slow, then retrieving those of /movies
+        self.app.config['SLOW_QUERY_SECONDS'] = 0
+        self.client().get('/movies')
+        res = self.client().get('/admin/slow-queries?route=get_movies')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['slow_queries'][0]['route'], 'get_movies')
+
+    # Creating a test too many requests for the /movies GET endpoint
+    def test_429_get_movies(self):
+        # Allowing a single request per token, then sending two
+        self.app.config['RATE_LIMIT_BURST'] = 1
+        self.app.config['RATE_LIMIT_PER_SECOND'] = 0.01
+        self.client().get('/movies')
+        res = self.client().get('/movies')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['code'], 'rate_limited')
+        self.assertTrue(res.headers['Retry-After'])
+
+    # Creating a test for the /movies POST endpoint with group commit
+    def test_200_post_movies_group_commit(self):
+        # Enabling group commit, then posting dummy movie data
+        self.app.extensions['group_commit'] = GroupCommitter(0.002, 64)
+        res = self.client().post(
+            '/movies', json={"title": "Boss Level", "release_year": 2020})
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['movies'][0]['id'])
+        self.assertEqual(data['movies'][0]['version'], 1)
+
+    # Creating a test unprocessable for a mistyped /actors POST body
+    def test_422_post_actors_invalid_type(self):
+        # Posting an age given as a string
+        res = self.client().post('/actors', json={"name": "Mel Gibson",
+                                                  'age': "64", 'gender': "male",
+                                                  'movie_id': 1})
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable')
+        self.assertEqual(data['errors'], {'age': 'must be an integer'})
+
+    # Creating a test for the /import/actors POST endpoint with an unknown movie
+    def test_200_import_actors_unknown_movie(self):
+        # Uploading two actors, the second one cast in a missing movie
+        res = self.client().post(
+            '/import/actors',
+            data='name,age,gender,movie_id\nMel Gibson,64,male,1\n'
+                 'Frank Grillo,55,male,100000\n',
+            content_type='text/csv')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that only the row with the unknown movie is rejected
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+
+    # Creating a test unprocessable for a CSV header missing a required column
+    def test_422_import_movies_missing_column(self):
+        # Uploading movies whose header names the title column differently
+        res = self.client().post(
+            '/import/movies',
+            data='name,release_year\nBoss Level,2020\n',
+            content_type='text/csv')
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that the upload is refused as a whole
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['errors'], {'header': 'is missing title'})
+
+    # Creating a test for concurrent identical /movies GET requests
+    def test_200_get_movies_coalesced(self):
+        # Slowing down the leader so that the followers arrive while it runs
+        before = coalescer.stats()['coalesced']
+        format_movie = Movie.format
+
+        def slow_format(movie):
+            time.sleep(0.2)
+            return format_movie(movie)
+
+        responses = []
+
+        def get_movies():
+            responses.append(self.client().get('/movies'))
+
+        with mock.patch.object(Movie, 'format', slow_format):
+            requests = [threading.Thread(target=get_movies) for _ in range(4)]
+            for request in requests:
+                request.start()
+            for request in requests:
+                request.join()
+
+        # Asserting that the followers shared the leader's response
+        self.assertEqual([res.status_code for res in responses], [200] * 4)
+        self.assertEqual(len(set(res.data for res in responses)), 1)
+        self.assertGreaterEqual(coalescer.stats()['coalesced'] - before, 1)
+
+    # Creating a test unprocessable for a mistyped version in a PATCH body
+    def test_422_update_movies_invalid_version(self):
+        # Calling patch endpoint with the version given as a string
+        res = self.client().patch('/movies/1', json={'title': 'Braveheart',
+                                                     'version': '1'})
+        # Transforming body response into JSON
+        data = json.loads(res.data)
+
+        # Asserting that tests are valid
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {'version': 'must be an integer'})
+
+    # Creating a test for concurrent writes committed in one batch
+    def test_group_commit_batch(self):
+        # Holding a first batch so that the next three writes join one batch
+        committer = GroupCommitter(5, 3)
+        started = threading.Event()
+        release = threading.Event()
+        results = {}
+
+        def hold(connection):
+            started.set()
+            release.wait(5)
+
+        def insert(title):
+            def work(connection):
+                connection.execute(Movie.__table__.insert().values(
+                    title=title, release_year=2020))
+                if title == 'Group Commit Failing':
+                    raise ValueError(title)
+                return title, connection.execute('SELECT txid_current()').scalar()
+            return work
+
+        def submit(name, work):
+            with self.app.app_context():
+                try:
+                    results[name] = committer.submit(work)
+                except ValueError as e:
+                    results[name] = e
+
+        titles = ['Group Commit One', 'Group Commit Two', 'Group Commit Failing']
+        first = threading.Thread(target=submit, args=('hold', hold))
+        first.start()
+        started.wait(5)
+        threads = [threading.Thread(target=submit, args=(title, insert(title)))
+                   for title in titles]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in [first] + threads:
+            thread.join()
+
+        # Asserting that the writes shared one transaction, each with its own
+        # result, and that only the failing one was rolled back
+        self.assertEqual(results['Group Commit One'][0], 'Group Commit One')
+        self.assertEqual(results['Group Commit Two'][0], 'Group Commit Two')
+        self.assertEqual(results['Group Commit One'][1], results['Group Commit Two'][1])
+        self.assertIsInstance(results['Group Commit Failing'], ValueError)
+        with self.app.app_context():
+            stored = [movie.title for movie in Movie.query.filter(Movie.title.in_(titles))]
+        self.assertEqual(sorted(stored), ['Group Commit One', 'Group Commit Two'])
+
+    # Creating a test for a rate limit that never refills
+    def test_create_app_zero_rate_limit(self):
+        # Creating an app whose token buckets would never refill
+        with self.assertRaises(ValueError):
+            create_app({"SQLALCHEMY_DATABASE_URI": self.database_path,
+                        "RATE_LIMIT_PER_SECOND": 0})
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":